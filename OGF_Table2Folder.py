@@ -37,47 +37,108 @@
 # SOFTWARE.
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import importlib.util
 import numpy as np
 import os
+import pandas as pd
 import shutil
+import sys
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+### Only check whether pyarrow is installed, pandas imports it when it is needed
+has_pyarrow = importlib.util.find_spec("pyarrow") is not None
+
+### Number of orthologs evaluated per block, so each block of counts stays in the L1/L2 cache of its thread
+_BLOCK_ROWS = 256
+
+if njit is not None:
+    @njit(parallel=True, cache=True, boundscheck=False)
+    def _filter_mask(counts, missing_thresh, max_copies):
+        """Evaluates the missing taxa and maximum copies thresholds for every ortholog in a single pass over the counts."""
+
+        n, k = counts.shape
+        out = np.empty(n, np.bool_)
+        n_blocks = (n + _BLOCK_ROWS - 1) // _BLOCK_ROWS
+
+        for block in prange(n_blocks):
+            start = block * _BLOCK_ROWS
+            for i in range(start, min(start + _BLOCK_ROWS, n)):
+                zeros = 0
+                ok = k > 0
+                for j in range(k):
+                    v = counts[i, j]
+                    ### Stop at the first species above the maximum copies, the most common rejection
+                    if v > max_copies:
+                        ok = False
+                        break
+                    ### Stop as soon as the missing taxa proportion can no longer be met
+                    if v == 0:
+                        zeros += 1
+                        if zeros / k > missing_thresh:
+                            ok = False
+                            break
+                out[i] = ok
 
-ogf = argparse.ArgumentParser(description="This Python 3 script allows the user to filter the orthologs resulting from an Orthofinder run"
-                                            "based on the number of individual copies and the percentage of missing taxa, defined as thresholds."
-                                            "Do not alter the files or structure created by OrthoFinder 2.5.5, because it will not work as intended.")
+        return out
 
-ogf.add_argument("--input", "-i", dest="input_orthofinder_folder", required=True, type=str, help="The full path to the main directory which has the OrthoFinder run(s) and fastas.")
+def _proportion(value):
+    """Validates that the proportion of missing taxa given by the user is a number between 0 and 1."""
 
-ogf.add_argument("--missing", "-t", dest="missing_taxa", required=True, choices=np.arange(0.1, 1.1, 0.1, dtype=float), type=float, help="The proportion of missing taxa.")
+    try:
+        proportion = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid proportion: '{value}', please enter a number between 0 and 1.")
 
-ogf.add_argument("--copies", "-c", dest="maximum_copies", required=True, type=int, help="The maximum number of copies permitted.")
+    if not 0.0 <= proportion <= 1.0:
+        raise argparse.ArgumentTypeError(f"invalid proportion: '{value}', please enter a number between 0 and 1.")
 
-args = ogf.parse_args()
+    return proportion
 
 class Table2Folder:
     """Contains the functions necessary to parse the information stored in Orthogroups.GeneCount.tsv, and copies the desired orthologs to a new folder."""
 
-    def __init__(self, orthofinder_directory, missing_taxa, maximum_copies):
+    def __init__(self, orthofinder_directory, missing_taxa, maximum_copies, run=None, required_species=None, link_mode="hardlink"):
         self.of_dir = orthofinder_directory
+        self.run = run
+        self.required_species = required_species
+        self.link_mode = link_mode
         self.missing = missing_taxa
         self.copies = maximum_copies
+        self.run_dir = None
+        self.og_dir = None
+        self.filtered_names = None
     
     def MainDir2OFolder(self):
         """This function will get to the OrthoFinder results folder starting from the main directory that was provided as input."""
         
         ### Check if there is a OrthoFinder folder
-        if "OrthoFinder" in os.listdir(self.of_dir):
-            os.chdir(os.path.join(self.of_dir, "OrthoFinder"))
-        else:
+        of_folder = os.path.abspath(os.path.join(self.of_dir, "OrthoFinder"))
+
+        if not os.path.isdir(of_folder):
             raise FileNotFoundError("\n!!! Could not find OrthoFinder folder in {}. !!!\n".format(self.of_dir))
-        
-        of_folder = os.getcwd()
 
-        ### Check how many runs there are, and choose the desired one     
-        runs = os.listdir(of_folder)
-        
+        ### Check how many runs there are, and choose the desired one, stray files in the folder are not runs
+        runs = sorted(entry.name for entry in os.scandir(of_folder) if entry.is_dir())
+
+        ### For a run chosen in the command line, either by name or by its number in the list
+        if self.run is not None:
+            run = str(self.run)
+            if run in runs:
+                selected_run = run
+            elif run.isdigit() and 1 <= int(run) <= len(runs):
+                selected_run = runs[int(run) - 1]
+            else:
+                raise FileNotFoundError("\n!!! Could not find OrthoFinder run {} in {}. !!!\n".format(self.run, of_folder))
+            print(f"\n********* Found OrthoFinder run folder. Retrieving orthologs... *********\n")
+
         ### For only 1 run    
-        if len(runs) == 1:
-            os.chdir(os.path.join(of_folder, runs[0]))
+        elif len(runs) == 1:
+            selected_run = runs[0]
             print(f"\n********* Found OrthoFinder run folder. Retrieving orthologs... *********\n")
 
         ### For no runs
@@ -86,6 +147,10 @@ class Table2Folder:
         
         ### For more than 1 run
         elif len(runs) > 1:
+            ### Without a terminal there is nobody to answer the prompt, e.g. in a pipeline
+            if not sys.stdin.isatty():
+                raise RuntimeError("\n!!! Found {} OrthoFinder runs in {}, please choose one with --run. !!!\n".format(len(runs), of_folder))
+
             print("\n********* Please choose the desired OrthoFinder run below. *********\n")
             for index, run in enumerate(runs):
                 print(f"{index + 1}: {run}")
@@ -103,113 +168,204 @@ class Table2Folder:
                 except ValueError:
                     print("\n!!! Invalid input. Please enter a number. !!!\n")
 
-            os.chdir(os.path.join(of_folder, selected_run))               
+        ### Keep the absolute paths of the selected run and its 'Orthogroups' folder
+        self.run_dir = os.path.join(of_folder, selected_run)
+        self.og_dir = os.path.join(self.run_dir, "Orthogroups")
 
     def OFolder2List(self):
         """This function will get a list containing the desired orthologs starting from the OrthoFinder results folder."""
 
-        ### Change to Orthogroups folder, where Orthogroups.GeneCount.tsv is located
-        run_folder = os.getcwd()
-        os.chdir(os.path.join(run_folder, "Orthogroups"))
-
-        ### Define Orthogroups.GeneCount.tsv and check if it exists
+        ### Define Orthogroups.GeneCount.tsv, located in the Orthogroups folder, and check if it exists
         tsv_file_name = "Orthogroups.GeneCount.tsv"
+        tsv_file_path = os.path.join(self.og_dir, tsv_file_name)
 
-        if not os.path.exists(tsv_file_name):
+        if not os.path.isfile(tsv_file_path):
             raise FileNotFoundError(f"\n!!! Could not find {tsv_file_name} in 'Orthogroups' folder. !!!\n")
         
-        with open(tsv_file_name, "r") as file:
-            orthologs = file.readlines()
-
-        ### Create a list with the desired orthologs and call the missing taxa and maximum copies arguments
-        line_list = []
-        missing = self.missing   ### Float
-        missing_list = []
-        copies = self.copies   ### Integer
-        final_list = []
-
-        for line in orthologs[1:]:
-            ### Split each line by tabs, tab separated values file
-            columns = line.strip().split('\t')
-
-            ### Exclude the copy count column
-            columns = columns[:-1]
+        ### Read the header once to know the ortholog name column, the species columns and the 'Total' column
+        with open(tsv_file_path, "r") as file:
+            header = file.readline().rstrip("\n").split("\t")
+        name_column, species_columns, total_column = header[0], header[1:-1], header[-1]
+
+        ### Map each species to its column once, so looking up species by name does not scan the header every time
+        col_idx = {species: index for index, species in enumerate(species_columns)}
+
+        ### Load the table with the pandas C parser from a memory map of the file, with the gene counts stored directly as integers
+        ### and the ortholog names as arrow-backed strings when pyarrow is available
+        column_dtypes = {name_column: "string[pyarrow]" if has_pyarrow else str}
+        column_dtypes.update({species: np.int32 for species in species_columns})
+        column_dtypes[total_column] = np.int64
+        table = pd.read_csv(tsv_file_path, sep="\t", dtype=column_dtypes, engine="c", memory_map=True)
+
+        ### The names stay in a Series, so only the kept orthologs are ever turned into Python strings
+        names = table[name_column]
+
+        ### The 'Total' of an ortholog bounds each of its counts, so when no total exceeds 255 the counts are stored as uint8,
+        ### converted in the same copy that makes the table row-major for the filters
+        fits_uint8 = table[total_column].max() <= np.iinfo(np.uint8).max
+        counts = np.ascontiguousarray(table[species_columns].to_numpy(), dtype=np.uint8 if fits_uint8 else np.int32)
+
+        ### The copies threshold is compared as a Python int, which NumPy compares exactly against any count dtype,
+        ### even when it lies outside the range of that dtype, without promoting the counts
+        max_copies = int(self.copies)
+
+        ### Apply the thresholds defined by the user, fused into a single pass when numba is available
+        if njit is not None:
+            keep = _filter_mask(counts, self.missing, max_copies)
+        else:
+            ### Otherwise use vectorized masks over the whole table
+            missing_frac = np.count_nonzero(counts == 0, axis=1) / counts.shape[1]
+            copies_ok = np.all(counts <= max_copies, axis=1)
+            keep = (missing_frac <= self.missing) & copies_ok
 
-            ### Append the remaining data to a list
-            line_list.append(columns)
-        
-            ### Apply the thresholds defined by the user
-        for entries in line_list:
-            count = sum( x == '0' for x in entries)
-            proportion = count / (len(entries) - 1)
-            if proportion <= missing:
-                missing_list.append(entries)
-        line_list = []
         print(f"\n********* Filtered orthologs based on the percentage of missing taxa allowed... *********\n")
-
-        for entries in missing_list:
-            ### Convert the numeric entries to integers so they can be matched to the copy number threshold
-            integers = list(map(int, entries[1:]))
-            if all(x <= copies for x in integers):
-                final_list.append(entries)
-        missing_list = []
         print(f"\n********* Filtered orthologs based on the maximum number of copies allowed... *********\n")
 
-        ### Convert the final list into a .txt file containing solely the ortholog file names
-        first_elements = [entry[0] for entry in final_list]
+        ### Keep only the orthologs present in every species required by the user
+        if self.required_species:
+            unknown_species = [species for species in self.required_species if species not in col_idx]
+            if unknown_species:
+                raise ValueError("\n!!! Could not find species {} in {}. !!!\n".format(", ".join(unknown_species), tsv_file_name))
 
-        ### Move one directory level up
-        os.chdir(os.path.dirname(os.getcwd()))
+            required_columns = [col_idx[species] for species in self.required_species]
+            keep &= np.all(counts[:, required_columns] > 0, axis=1)
+            print(f"\n********* Filtered orthologs based on the species required... *********\n")
+
+        ### Keep the filtered names in memory so they can be used directly when copying
+        self.filtered_names = names[keep]
+
+        ### Write the names of the kept orthologs to a new text file in the run folder, for inspection
+        ### with a single buffered write instead of one write per ortholog
+        with open(os.path.join(self.run_dir, "FilteredOrthologs.txt"), "w", buffering=1 << 20) as file:
+            if len(self.filtered_names):
+                file.write("\n".join(self.filtered_names) + "\n")
 
-        ### Write the previous variable to a new text file
-        with open("FilteredOrthologs.txt", "w") as file:
-            for entry in first_elements:
-                file.write(entry + "\n")
-        
         print(f"\n********* Orthologs succesfully retrieved. Copying to a new folder... *********\n")
                     
 
+    @staticmethod
+    def _CopyFasta(source, destination, link_mode="hardlink"):
+        """Places a single .fa file in the destination as a hardlink, a symlink or a copy, depending on the link mode chosen.
+        Returns True if the file was linked, and False if it was copied."""
+
+        ### Remove a file left by a previous run, it may be a link to the source that must not be overwritten
+        if os.path.lexists(destination):
+            os.remove(destination)
+
+        ### Link the file when possible, falling back to a copy e.g. across filesystems
+        if link_mode != "copy":
+            try:
+                if link_mode == "hardlink":
+                    os.link(source, destination)
+                else:
+                    os.symlink(source, destination)
+                return True
+            except OSError:
+                pass
+
+        ### Copy the file in the kernel with os.copy_file_range, falling back to shutil.copy2 where it is not supported
+        try:
+            with open(source, "rb") as src, open(destination, "wb") as dst:
+                remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    ### Some filesystems stop early, let shutil.copy2 rewrite the file instead of keeping a short copy
+                    if copied == 0:
+                        raise OSError("os.copy_file_range stopped before the end of {}".format(source))
+                    remaining -= copied
+            shutil.copystat(source, destination)
+
+        except (AttributeError, OSError):
+            shutil.copy2(source, destination)
+
+        return False
+
     def List2Folder(self):    
         """This function will copy and paste the desired orthologs to a new folder contained in the 'Orthogroups' folder."""
 
-        ### Define current working directory
-        current_directory = os.getcwd()
-        filtered_ogs = os.path.join(current_directory, "Filtered_Orthologs")
+        ### Define the sequences and destination folders inside the run folder
+        seq_dir = os.path.join(self.run_dir, "Orthogroup_Sequences")
+        filtered_ogs = os.path.join(self.run_dir, "Filtered_Orthologs")
 
         ### Create the folder if there is none yet
-        if not os.path.exists(filtered_ogs):
-            os.makedirs(filtered_ogs)
+        os.makedirs(filtered_ogs, exist_ok=True)
 
-        ### Read the file names from the .txt list
-        with open("FilteredOrthologs.txt", "r") as file:
-            og_names = file.read().splitlines()
+        ### Use the filtered names kept in memory, or read them from the .txt list if they are not available
+        if self.filtered_names is not None:
+            og_names = self.filtered_names
+        else:
+            with open(os.path.join(self.run_dir, "FilteredOrthologs.txt"), "r") as file:
+                og_names = file.read().splitlines()
+
+        ### Check if there is a Orthogroup_Sequences folder
+        if not os.path.isdir(seq_dir):
+            raise FileNotFoundError("\n!!! Could not find 'Orthogroup_Sequences' folder in {}. !!!\n".format(self.run_dir))
+
+        ### List the available .fa files once, instead of checking each ortholog individually
+        available = {entry.name[:-3] for entry in os.scandir(seq_dir) if entry.name.endswith(".fa")}
+
+        ### Collect the (source, destination) pairs of the orthologs to copy
+        copy_jobs = []
 
-        ### Initiate a count to keep track of how many files were copied
-        og_count = 0
-        
-        ### Iterate through the orthologs
         for label in og_names:
             ### Check if any .fa file corresponds to the label
             fasta = "{}.fa".format(label)
-            file_path = os.path.join(current_directory, "Orthogroup_Sequences", fasta)
 
-            if os.path.exists(file_path):
-                ### Copy the file to the Filtered_Orthologs directory
-                destination = os.path.join(filtered_ogs, fasta)
-                shutil.copy2(file_path, destination)
-                og_count += 1 
+            if label in available:
+                copy_jobs.append((os.path.join(seq_dir, fasta), os.path.join(filtered_ogs, fasta)))
             else:
                 print(f"File {fasta} not found.")
 
-        print(f"\n********* {og_count} orthologs were identified and successfully copied to the 'Filtered_Orthologs' folder. *********\n")
+        ### Link or copy the files to the Filtered_Orthologs directory in parallel, the operations are I/O bound
+        max_workers = min(32, (os.cpu_count() or 1) * 4)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            linked = list(executor.map(lambda job: self._CopyFasta(*job, self.link_mode), copy_jobs))
+
+        ### Keep track of how many files were linked and copied
+        og_count = len(copy_jobs)
+        linked_count = sum(linked)
+        copied_count = og_count - linked_count
+
+        if linked_count:
+            print(f"\n********* {og_count} orthologs were identified and placed in the 'Filtered_Orthologs' folder: "
+                  f"{linked_count} as {self.link_mode}s and {copied_count} copied. *********\n")
+            print(f"!!! Linked files share their data with the originals in 'Orthogroup_Sequences', editing them in place "
+                  f"(e.g. renaming headers or trimming) also changes the OrthoFinder files. Use '--link-mode copy' to edit them safely. !!!\n")
+        else:
+            print(f"\n********* {og_count} orthologs were identified and successfully copied to the 'Filtered_Orthologs' folder. *********\n")
 
 def main():
+    ### Parse the command line arguments
+    ogf = argparse.ArgumentParser(description="This Python 3 script allows the user to filter the orthologs resulting from an Orthofinder run"
+                                                "based on the number of individual copies and the percentage of missing taxa, defined as thresholds."
+                                                "Do not alter the files or structure created by OrthoFinder 2.5.5, because it will not work as intended.")
+
+    ogf.add_argument("--input", "-i", dest="input_orthofinder_folder", required=True, type=str, help="The full path to the main directory which has the OrthoFinder run(s) and fastas.")
+
+    ogf.add_argument("--missing", "-t", dest="missing_taxa", required=True, type=_proportion, help="The proportion of missing taxa, between 0 and 1.")
+
+    ogf.add_argument("--copies", "-c", dest="maximum_copies", required=True, type=int, help="The maximum number of copies permitted.")
+
+    ogf.add_argument("--run", "-r", dest="orthofinder_run", default=None, type=str, help="The OrthoFinder run to use, by folder name or by its number in the list, when there is more than one.")
+
+    ogf.add_argument("--require-species", "-s", dest="required_species", nargs="+", default=None, type=str, help="The species, as named in Orthogroups.GeneCount.tsv, that must be present in every ortholog kept.")
+
+    ogf.add_argument("--link-mode", "-l", dest="link_mode", default="hardlink", choices=["hardlink", "symlink", "copy"], type=str, help="How the orthologs are placed in the new folder (default: hardlink). Hardlinks and symlinks share their data with the originals in 'Orthogroup_Sequences', "
+                                                                                                                                        "so editing the filtered files in place (e.g. renaming headers or trimming) also changes the OrthoFinder files, use 'copy' if they will be edited. "
+                                                                                                                                        "Links fall back to copies when they are not possible, e.g. across filesystems.")
+
+    args = ogf.parse_args()
+
     ### Matching arguments with their intended variables
     orthofinder_directory = args.input_orthofinder_folder
     missing_taxa = args.missing_taxa
     maximum_copies = args.maximum_copies
+    orthofinder_run = args.orthofinder_run
+    required_species = args.required_species
+    link_mode = args.link_mode
 
-    table2folder = Table2Folder(orthofinder_directory, missing_taxa, maximum_copies)
+    table2folder = Table2Folder(orthofinder_directory, missing_taxa, maximum_copies, orthofinder_run, required_species, link_mode)
 
     ### Start running the functions
     table2folder.MainDir2OFolder()